@@ -18,6 +18,7 @@
 """
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Optional
 from urllib.parse import urlparse
 import datetime
@@ -30,16 +31,56 @@ import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
 # hot-loaded if needed, see import_module():
 #  imagesize
 #  requests
 
+# optional, only used if already installed: orjson parses JSON considerably faster than the json module
+try:
+    import orjson
+
+    def json_loads(data):
+        """Parses JSON with orjson, falling back to the json module for input that orjson is stricter about
+           (e.g. unpaired surrogate escapes or NaN, which the json module accepts)."""
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+except ImportError:
+    json_loads = json.loads
+
 
 # Print a compile-time error in Python < 3.6. This line does nothing in Python 3.6+ but is reported to the user
 # as an error (because it is the first line that fails to compile) in older versions.
 f' Error: This script requires Python 3.6 or later. Use `python --version` to check your version.'
 
+# Upper limit for the number of requests that are sent to Twitter at the same time
+MAX_CONCURRENT_REQUESTS = 8
+# Number of bytes that are read from the network and written to disk at a time when downloading media
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Maximum number of user ids that Twitter accepts in a single users/lookup request
+USER_LOOKUP_BATCH_SIZE = 100
+# Twitter allows this many users/lookup requests per rate limit period (in seconds)
+USER_LOOKUP_RATE_LIMIT = 300
+USER_LOOKUP_RATE_LIMIT_PERIOD = 15 * 60
+# Upper limit for the number of media files that are downloaded at the same time
+MAX_CONCURRENT_DOWNLOADS = 8
+
+# Matches all occurrences of '@username ' at the start of a tweet body
+REPLYING_TO_PATTERN = re.compile(r'^(@[0-9A-Za-z_]* )*')
+
+# Matches markdown control characters and line breaks, so that both can be escaped in a single pass
+MARKDOWN_ESCAPE_PATTERN = re.compile(r'(?P<control>[\\_*\[\]()~`>#+\-=|{}.!])|(?P<newline>\n)')
+
+# Keys that a message must have to be included in the output, checked with a single subset test per message
+DM_REQUIRED_KEYS = frozenset(['senderId', 'recipientId', 'text', 'createdAt'])
+GROUP_DM_REQUIRED_KEYS = frozenset(['senderId', 'text', 'createdAt'])
+
+# Holds one requests.Session per download thread, see get_thread_local_session()
+thread_local = threading.local()
+
 
 class UserData:
     def __init__(self, user_id: str, handle: str):
@@ -51,6 +92,35 @@ class UserData:
         self.handle = handle
 
 
+class TokenBucket:
+    """
+    Limits the rate at which requests are sent, shared by all threads that use the same instance.
+
+    Up to `capacity` requests can be sent right away. After that, take() blocks each caller until its request
+    fits into the rate of `capacity` requests per `period` seconds. Waiting before sending a request is cheaper
+    than having the server reject it (and possibly block us for a while).
+    """
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Blocks until the caller is allowed to send a request."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            # Reserve a token, possibly one that will only be refilled in the future, and wait for it outside the
+            # lock so that other threads can make their reservations in the meantime.
+            self.tokens -= 1
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
 class PathConfig:
     """
     Helper class containing constants for various directories and files.
@@ -80,6 +150,9 @@ class PathConfig:
         self.file_output_following          = os.path.join(self.dir_output,         'following.txt')
         self.file_output_followers          = os.path.join(self.dir_output,         'followers.txt')
         self.file_download_log              = os.path.join(self.dir_output_media,   'download_log.txt')
+        self.file_media_cache               = os.path.join(self.dir_output_cache,   'media_cache.json')
+        self.file_known_users               = os.path.join(self.dir_output_cache,   'known_users.json')
+        self.file_known_users_log           = os.path.join(self.dir_output_cache,   'known_users.jsonl')
         self.file_tweet_icon                = os.path.join(self.dir_output_media,   'tweet.ico')
         self.files_input_tweets             = find_files_input_tweets(self.dir_input_data)
 
@@ -158,43 +231,127 @@ def rel_url(media_path, document_path):
     return os.path.relpath(media_path, os.path.split(document_path)[0]).replace("\\", "/")
 
 
+def create_session():
+    """Returns a requests.Session whose connection pool is large enough for all concurrent requests,
+       and which retries temporary server errors with an increasing back-off."""
+    requests = import_module('requests')
+    session = requests.Session()
+    Retry = requests.adapters.Retry
+    retry_options = {
+        'total': 5,
+        'backoff_factor': 0.5,
+        'status_forcelist': [429, 500, 502, 503, 504],
+        # let the callers report the final status code instead of raising an exception
+        'raise_on_status': False,
+    }
+    # users/lookup is sent as POST but doesn't change anything, so it is safe to retry.
+    # urllib3 versions before 1.26 call this option method_whitelist.
+    if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS'):
+        retry_options['allowed_methods'] = Retry.DEFAULT_ALLOWED_METHODS | {'POST'}
+    else:
+        retry_options['method_whitelist'] = Retry.DEFAULT_METHOD_WHITELIST | {'POST'}
+    retry = Retry(**retry_options)
+    pool_size = max(MAX_CONCURRENT_REQUESTS, MAX_CONCURRENT_DOWNLOADS)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 def get_twitter_api_guest_token(session, bearer_token):
     """Returns a Twitter API guest token for the current session."""
     guest_token_response = session.post("https://api.twitter.com/1.1/guest/activate.json",
                                         headers={'authorization': f'Bearer {bearer_token}'},
                                         timeout=2,
                                         )
-    guest_token = json.loads(guest_token_response.content)['guest_token']
+    guest_token = json_loads(guest_token_response.content)['guest_token']
     if not guest_token:
         raise Exception(f"Failed to retrieve guest token")
     return guest_token
 
 
-def get_twitter_users(session, bearer_token, guest_token, user_ids):
-    """Asks Twitter for all metadata associated with user_ids."""
+def get_twitter_users_batch(session, bearer_token, guest_token, user_id_batch, rate_limiter: TokenBucket):
+    """Asks Twitter for all metadata associated with a single batch of (at most USER_LOOKUP_BATCH_SIZE) user_ids."""
+    user_id_list = ",".join(user_id_batch)
+    rate_limiter.take()
+    # POST the ids in the request body, so that a full batch doesn't produce an overly long URL
+    response = session.post("https://api.twitter.com/1.1/users/lookup.json",
+                            data={'user_id': user_id_list},
+                            headers={'authorization': f'Bearer {bearer_token}', 'x-guest-token': guest_token},
+                            timeout=2,
+                            )
+    if not response.status_code == 200:
+        raise Exception(f'Failed to get user handle: {response}')
+    return json_loads(response.content)
+
+
+def get_twitter_users(session, bearer_token, guest_token, user_ids, known_users_log):
+    """Asks Twitter for all metadata associated with user_ids.
+       The batches are independent of each other, so several of them are requested concurrently.
+       The handle of every retrieved user is appended to known_users_log as soon as its batch arrives,
+       so that the data is not lost if the script is interrupted."""
     users = {}
-    while user_ids:
-        max_batch = 100
-        user_id_batch = user_ids[:max_batch]
-        user_ids = user_ids[max_batch:]
-        user_id_list = ",".join(user_id_batch)
-        query_url = f"https://api.twitter.com/1.1/users/lookup.json?user_id={user_id_list}"
-        response = session.get(query_url,
-                               headers={'authorization': f'Bearer {bearer_token}', 'x-guest-token': guest_token},
-                               timeout=2,
-                               )
-        if not response.status_code == 200:
-            raise Exception(f'Failed to get user handle: {response}')
-        response_json = json.loads(response.content)
-        for user in response_json:
-            users[user["id_str"]] = user
+    rate_limiter = TokenBucket(USER_LOOKUP_RATE_LIMIT, USER_LOOKUP_RATE_LIMIT_PERIOD)
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        futures = [
+            executor.submit(get_twitter_users_batch, session, bearer_token, guest_token, user_id_batch, rate_limiter)
+            for user_id_batch in chunks(user_ids, USER_LOOKUP_BATCH_SIZE)
+        ]
+        try:
+            for future in as_completed(futures):
+                for user in future.result():
+                    users[user["id_str"]] = user
+                    if user["screen_name"] is not None:
+                        known_users_log.write(json.dumps({user["id_str"]: user["screen_name"]}) + '\n')
+                known_users_log.flush()
+        except BaseException:
+            # Don't wait for the remaining batches if one failed or the user pressed Ctrl-C
+            for future in futures:
+                future.cancel()
+            raise
     return users
 
 
-def lookup_users(user_ids, users):
-    """Fill the users dictionary with data from Twitter"""
-    # Filter out any users already known
-    filtered_user_ids = [id for id in user_ids if id not in users]
+def load_known_users(paths: PathConfig) -> dict:
+    """Returns the user_id:handle mappings that were looked up online in earlier runs. Includes the mappings
+       from paths.file_known_users_log, which only exists if an earlier lookup didn't finish cleanly."""
+    known_users = {}
+    if os.path.isfile(paths.file_known_users):
+        try:
+            with open(paths.file_known_users, 'rb') as f:
+                known_users = json_loads(f.read())
+        except ValueError:
+            # the cache is disposable: losing it only means that some handles are looked up online again
+            print(f'Warning: ignoring unreadable {paths.file_known_users}')
+    if os.path.isfile(paths.file_known_users_log):
+        with open(paths.file_known_users_log, 'rb') as f:
+            for line in f:
+                try:
+                    known_users.update(json_loads(line))
+                except ValueError:
+                    pass  # the last line is incomplete if the script was killed while writing it
+    return known_users
+
+
+def save_known_users(known_users: dict, paths: PathConfig):
+    """Writes known_users, merged with everything in paths.file_known_users_log, to paths.file_known_users
+       (replacing it atomically) and deletes the no longer needed paths.file_known_users_log."""
+    # The log may hold handles that never made it into known_users (e.g. if the lookup failed part-way)
+    for user_id, handle in load_known_users(paths).items():
+        known_users.setdefault(user_id, handle)
+    tmp_filename = paths.file_known_users + '.tmp'
+    with open_and_mkdirs(tmp_filename) as f:
+        json.dump(known_users, f)
+    os.replace(tmp_filename, paths.file_known_users)
+    if os.path.isfile(paths.file_known_users_log):
+        os.remove(paths.file_known_users_log)
+
+
+def lookup_users(user_ids, users, known_users: dict, paths: PathConfig):
+    """Fill the users dictionary with data from Twitter.
+       The retrieved handles are also added to known_users, and logged to paths.file_known_users_log."""
+    # Filter out any users already known (and any duplicates) with a single set operation
+    filtered_user_ids = list(set(user_ids).difference(users))
     if not filtered_user_ids:
         # Don't bother opening a session if there's nothing to get
         return
@@ -204,36 +361,48 @@ def lookup_users(user_ids, users):
     if not get_consent(f'Download user data from Twitter (approx {estimated_size:,} KB)?'):
         return
 
-    requests = import_module('requests')
     try:
-        with requests.Session() as session:
+        with create_session() as session:
             bearer_token = 'AAAAAAAAAAAAAAAAAAAAANRILgAAAAAAnNwIzUejRCOuH5E6I8xnZz4puTs%3D1Zv7ttfk8LF81IUq16cHjhLTvJu4FA33AGWWjCpTnA'
             guest_token = get_twitter_api_guest_token(session, bearer_token)
-            retrieved_users = get_twitter_users(session, bearer_token, guest_token, filtered_user_ids)
+            mkdirs_for_file(paths.file_known_users_log)
+            with open(paths.file_known_users_log, 'a', encoding='utf-8') as known_users_log:
+                retrieved_users = get_twitter_users(
+                    session, bearer_token, guest_token, filtered_user_ids, known_users_log
+                )
             for user_id, user in retrieved_users.items():
                 if user["screen_name"] is not None:
                     users[user_id] = UserData(user_id=user_id, handle=user["screen_name"])
+                    known_users[user_id] = user["screen_name"]
         print()  # empty line for better readability of output
     except Exception as err:
         print(f'Failed to download user data: {err}')
+        # The batches that did arrive were logged as soon as they came in, so use them anyway
+        for user_id, handle in load_known_users(paths).items():
+            known_users.setdefault(user_id, handle)
+            if user_id not in users:
+                users[user_id] = UserData(user_id=user_id, handle=handle)
 
 
 def read_json_from_js_file(filename):
     """Reads the contents of a Twitter-produced .js file into a dictionary."""
     print(f'Parsing {filename}...')
-    with open(filename, 'r', encoding='utf8') as f:
-        data = f.readlines()
-        # if the JSON has no real content, it can happen that the file is only one line long.
-        # in this case, return an empty dict to avoid errors while trying to read non-existing lines.
-        if len(data) <= 1:
-            return {}
-        # convert js file to JSON: replace first line with just '[', squash lines into a single string
-        prefix = '['
-        if '{' in data[0]:
-            prefix += ' {'
-        data =  prefix + ''.join(data[1:])
-        # parse the resulting JSON and return as a dict
-        return json.loads(data)
+    # read as bytes: the JSON parser decodes the UTF-8 itself, in one go, without a separate text decoding step
+    with open(filename, 'rb') as f:
+        # read the first line separately, so that the (possibly huge) rest of the file
+        # can be read in one piece instead of being split into a list of lines
+        first_line = f.readline()
+        data = f.read()
+    # if the JSON has no real content, it can happen that the file is only one line long.
+    # in this case, return an empty dict to avoid errors while trying to read non-existing lines.
+    if not data:
+        return {}
+    # convert js file to JSON: replace first line with just '['
+    prefix = b'['
+    if b'{' in first_line:
+        prefix += b' {'
+    # parse the resulting JSON and return as a dict
+    return json_loads(prefix + data)
 
 
 def extract_username(paths: PathConfig):
@@ -242,27 +411,26 @@ def extract_username(paths: PathConfig):
     return account[0]['account']['username']
 
 
+def escape_markdown_match(match) -> str:
+    """Returns the escaped version of a single match of MARKDOWN_ESCAPE_PATTERN."""
+    if match.lastgroup == 'control':
+        # add backslash before control char
+        return '\\' + match[0]
+    # add double space before line break
+    return '  \n'
+
+
 def escape_markdown(input_text: str) -> str:
     """
     Escape markdown control characters from input text so that the text will not break in rendered markdown.
     (Only use on unformatted text parts that do not yet have any markdown control characters added on purpose!)
     """
-    characters_to_escape: str = r"\_*[]()~`>#+-=|{}.!"
-    output_text: str = ''
-    for char in input_text:
-        if char in characters_to_escape:
-            # add backslash before control char
-            output_text = output_text + "\\" + char
-        elif char == '\n':
-            # add double space before line break
-            output_text = output_text + "  " + char
-        else:
-            output_text = output_text + char
-    return output_text
+    return MARKDOWN_ESCAPE_PATTERN.sub(escape_markdown_match, input_text)
 
 
-def convert_tweet(tweet, username, media_sources, users: dict, paths: PathConfig):
-    """Converts a JSON-format tweet. Returns tuple of timestamp, markdown and HTML."""
+def convert_tweet(tweet, username, media_sources, users: dict, input_media_files: dict, paths: PathConfig):
+    """Converts a JSON-format tweet. Returns tuple of timestamp, markdown and HTML.
+       input_media_files is the index of paths.dir_input_media, see index_files_by_id()."""
     if 'tweet' in tweet.keys():
         tweet = tweet['tweet']
     timestamp_str = tweet['created_at']
@@ -305,7 +473,8 @@ def convert_tweet(tweet, username, media_sources, users: dict, paths: PathConfig
     header_html = ''
     if 'in_reply_to_status_id' in tweet:
         # match and remove all occurrences of '@username ' at the start of the body
-        replying_to = re.match(r'^(@[0-9A-Za-z_]* )*', body_markdown)[0]
+        # (only bother the regex engine if the body starts with an '@' at all)
+        replying_to = REPLYING_TO_PATTERN.match(body_markdown)[0] if body_markdown.startswith('@') else ''
         if replying_to:
             body_markdown = body_markdown[len(replying_to):]
             body_html = body_html[len(replying_to):]
@@ -332,7 +501,7 @@ def convert_tweet(tweet, username, media_sources, users: dict, paths: PathConfig
         for media in tweet['extended_entities']['media']:
             if 'url' in media and 'media_url' in media:
                 original_expanded_url = media['media_url']
-                original_filename = os.path.split(original_expanded_url)[1]
+                original_filename = os.path.basename(urlparse(original_expanded_url).path)
                 archive_media_filename = tweet_id_str + '-' + original_filename
                 archive_media_path = os.path.join(paths.dir_input_media, archive_media_filename)
                 file_output_media = os.path.join(paths.dir_output_media, archive_media_filename)
@@ -352,7 +521,7 @@ def convert_tweet(tweet, username, media_sources, users: dict, paths: PathConfig
                     )
                 else:
                     # Is there any other file that includes the tweet_id in its filename?
-                    archive_media_paths = glob.glob(os.path.join(paths.dir_input_media, tweet_id_str + '*'))
+                    archive_media_paths = input_media_files.get(tweet_id_str, [])
                     if len(archive_media_paths) > 0:
                         for archive_media_path in archive_media_paths:
                             archive_media_filename = os.path.split(archive_media_path)[-1]
@@ -367,22 +536,22 @@ def convert_tweet(tweet, username, media_sources, users: dict, paths: PathConfig
                             # Save the online location of the best-quality version of this file,
                             # for later upgrading if wanted
                             if 'video_info' in media and 'variants' in media['video_info']:
-                                best_quality_url = ''
-                                best_bitrate = -1 # some valid videos are marked with bitrate=0 in the JSON
-                                for variant in media['video_info']['variants']:
-                                    if 'bitrate' in variant:
-                                        bitrate = int(variant['bitrate'])
-                                        if bitrate > best_bitrate:
-                                            best_quality_url = variant['url']
-                                            best_bitrate = bitrate
-                                if best_bitrate == -1:
+                                # only consider mp4 files, not streaming playlists (which may also have a bitrate)
+                                mp4_variants = [
+                                    variant for variant in media['video_info']['variants']
+                                    if variant.get('content_type') == 'video/mp4' and 'bitrate' in variant
+                                ]
+                                # some valid videos are marked with bitrate=0 in the JSON
+                                best_variant = max(mp4_variants, key=lambda variant: int(variant['bitrate']),
+                                                   default=None)
+                                if best_variant is None:
                                     print(f"Warning No URL found for {original_url} {original_expanded_url} "
                                           f"{archive_media_path} {media_url}")
                                     print(f"JSON: {tweet}")
                                 else:
                                     media_sources.append(
                                         (os.path.join(paths.dir_output_media, archive_media_filename),
-                                         best_quality_url)
+                                         best_variant['url'])
                                     )
                     else:
                         print(f'Warning: missing local file: {archive_media_path}. Using original link instead: '
@@ -447,23 +616,58 @@ def find_dir_input_media(dir_path_input_data):
     return input_media_dirs[0]
 
 
-def download_file_if_larger(url, filename, index, count, sleep_time):
+def get_thread_local_session():
+    """Returns a requests.Session that belongs to the calling thread, so that its connections can be re-used
+       by all downloads running on that thread."""
+    session = getattr(thread_local, 'session', None)
+    if session is None:
+        session = create_session()
+        thread_local.session = session
+    return session
+
+
+def remember_media_version(media_cache, url, filename):
+    """Stores the size of the local file, which is now known to be the best version available from url,
+       in media_cache, so that later runs don't need to ask the server about it again."""
+    media_cache[url] = {'size': os.path.getsize(filename)}
+
+
+def index_files_by_id(dir_path) -> dict:
+    """Maps the id at the start of each file name in dir_path (the part before the first '-', e.g. a tweet id)
+       to the paths of all files with that id. Looking ids up in this dict is much cheaper than scanning the
+       directory again for every tweet or message."""
+    files_by_id = defaultdict(list)
+    if os.path.isdir(dir_path):
+        for file_name in sorted(os.listdir(dir_path)):
+            files_by_id[file_name.split('-', 1)[0]].append(os.path.join(dir_path, file_name))
+    return files_by_id
+
+
+def download_file_if_larger(url, filename, index, count, rate_limiter: TokenBucket, media_cache):
     """Attempts to download from the specified URL. Overwrites file if larger.
        Returns whether the file is now known to be the largest available, and the number of bytes downloaded.
+       Skips the request entirely if media_cache says that an earlier run already ended up with this very file.
+       Safe to call from several threads at once, as long as each call uses a different filename
+       (see download_file_from_urls()).
+       Reports only the final outcome, as a single log line, so that the output of concurrent calls doesn't mix.
     """
-    requests = import_module('requests')
+    session = get_thread_local_session()
     imagesize = import_module('imagesize')
 
     pref = f'{index:3d}/{count:3d} {filename}: '
-    # Sleep briefly, in an attempt to minimize the possibility of trigging some auto-cutoff mechanism
-    if index > 1:
-        print(f'{pref}Sleeping...', end='\r')
-        time.sleep(sleep_time)
-    # Request the URL (in stream mode so that we can conditionally abort depending on the headers)
-    print(f'{pref}Requesting headers for {url}...', end='\r')
     byte_size_before = os.path.getsize(filename)
+    # The media URLs are content-addressed, so if the local file is still the one that was recorded as the best
+    # version, asking the server again (even with a conditional request) can't tell us anything new.
+    cached = media_cache.get(url)
+    if cached is not None and cached['size'] == byte_size_before:
+        logging.info(f'{pref}SKIPPED. Already known to be the best version from an earlier run. Not requested.')
+        return True, 0
+    # Wait for our turn, in an attempt to minimize the possibility of trigging some auto-cutoff mechanism
+    rate_limiter.take()
+    # Request the URL (in stream mode so that we can conditionally abort depending on the headers)
+    tmp_filename = filename+'.tmp'
     try:
-        with requests.get(url, stream=True, timeout=2) as res:
+        with session.get(url, stream=True, timeout=2) as res:
             if not res.status_code == 200:
                 # Try to get content of response as `res.text`.
                 # For twitter.com, this will be empty in most (all?) cases.
@@ -472,11 +676,10 @@ def download_file_if_larger(url, filename, index, count, sleep_time):
                                 f'Response content: "{res.text}"')
             byte_size_after = int(res.headers['content-length'])
             if byte_size_after != byte_size_before:
-                # Proceed with the full download
-                tmp_filename = filename+'.tmp'
-                print(f'{pref}Downloading {url}...            ', end='\r')
+                # Proceed with the full download, streaming it to disk in chunks instead of holding it in memory
+                res.raw.decode_content = True
                 with open(tmp_filename,'wb') as f:
-                    shutil.copyfileobj(res.raw, f)
+                    shutil.copyfileobj(res.raw, f, DOWNLOAD_CHUNK_SIZE)
                 post = f'{byte_size_after/2**20:.1f}MB downloaded'
                 width_before, height_before = imagesize.get(filename)
                 width_after, height_after = imagesize.get(tmp_filename)
@@ -486,6 +689,7 @@ def download_file_if_larger(url, filename, index, count, sleep_time):
                 if width_before == -1 and height_before == -1 and width_after == -1 and height_after == -1:
                     # could not check size of both versions, probably a video or unsupported image format
                     os.replace(tmp_filename, filename)
+                    remember_media_version(media_cache, url, filename)
                     bytes_percentage_increase = 100.0 * (byte_size_after - byte_size_before) / byte_size_before
                     logging.info(f'{pref}SUCCESS. New version is {bytes_percentage_increase:3.0f}% '
                                  f'larger in bytes (pixel comparison not possible). {post}')
@@ -497,6 +701,7 @@ def download_file_if_larger(url, filename, index, count, sleep_time):
                     return False, byte_size_after
                 elif pixels_after >= pixels_before:
                     os.replace(tmp_filename, filename)
+                    remember_media_version(media_cache, url, filename)
                     bytes_percentage_increase = 100.0 * (byte_size_after - byte_size_before) / byte_size_before
                     if bytes_percentage_increase >= 0:
                         logging.info(f'{pref}SUCCESS. New version is {bytes_percentage_increase:3.0f}% larger in bytes '
@@ -507,22 +712,104 @@ def download_file_if_larger(url, filename, index, count, sleep_time):
                                      f'larger in pixels. {post}')
                     return True, byte_size_after
                 else:
+                    remember_media_version(media_cache, url, filename)
                     logging.info(f'{pref}SKIPPED. Online version has {-pixels_percentage_increase:3.0f}% '
                                  f'smaller pixel size. {post}')
                     return True, byte_size_after
             else:
+                remember_media_version(media_cache, url, filename)
                 logging.info(f'{pref}SKIPPED. Online version is same byte size, assuming same content. Not downloaded.')
                 return True, 0
     except Exception as err:
         logging.error(f"{pref}FAIL. Media couldn't be retrieved from {url} because of exception: {err}")
         return False, 0
+    finally:
+        # Don't leave partial or rejected downloads behind
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def load_media_cache(paths: PathConfig) -> dict:
+    """Returns the sizes of the media files that earlier runs found to be the best versions, keyed by URL.
+       An unreadable cache is treated as empty: that only costs some requests, which will rebuild it."""
+    if not os.path.isfile(paths.file_media_cache):
+        return {}
+    try:
+        with open(paths.file_media_cache, 'rb') as f:
+            return json_loads(f.read())
+    except ValueError:
+        print(f'Warning: ignoring unreadable {paths.file_media_cache}')
+        return {}
+
+
+def save_media_cache(media_cache: dict, paths: PathConfig):
+    """Writes media_cache to paths.file_media_cache, replacing it atomically so that an interruption while
+       writing can't leave a truncated file behind."""
+    tmp_filename = paths.file_media_cache + '.tmp'
+    with open_and_mkdirs(tmp_filename) as f:
+        json.dump(media_cache, f)
+    os.replace(tmp_filename, paths.file_media_cache)
+
+
+def download_file_from_urls(urls, filename, index, count, rate_limiter: TokenBucket, media_cache):
+    """Tries each of the URLs for filename in turn, with download_file_if_larger(). Running all URLs of one file
+       in the same task makes sure that no two threads ever write to the same file (or its .tmp file).
+       Returns the URLs that failed, and the total number of bytes downloaded.
+    """
+    failed_urls = []
+    total_bytes_downloaded = 0
+    for url in urls:
+        success, bytes_downloaded = download_file_if_larger(url, filename, index, count, rate_limiter, media_cache)
+        if not success:
+            failed_urls.append(url)
+        total_bytes_downloaded += bytes_downloaded
+    return failed_urls, total_bytes_downloaded
+
+
+def print_download_progress(done_count, number_of_files, start_time):
+    """Shows % done and the estimated remaining time of the media downloads."""
+    time_elapsed: float = time.time() - start_time
+    estimated_time_per_file: float = time_elapsed / done_count
+    estimated_time_remaining: datetime.datetime = \
+        datetime.datetime.fromtimestamp(
+            (number_of_files - done_count) * estimated_time_per_file,
+            tz=datetime.timezone.utc
+        )
+    if estimated_time_remaining.hour >= 1:
+        time_remaining_string: str = \
+            f"{estimated_time_remaining.hour} hour{'' if estimated_time_remaining.hour == 1 else 's'} " \
+            f"{estimated_time_remaining.minute} minute{'' if estimated_time_remaining.minute == 1 else 's'}"
+    elif estimated_time_remaining.minute >= 1:
+        time_remaining_string: str = \
+            f"{estimated_time_remaining.minute} minute{'' if estimated_time_remaining.minute == 1 else 's'} " \
+            f"{estimated_time_remaining.second} second{'' if estimated_time_remaining.second == 1 else 's'}"
+    else:
+        time_remaining_string: str = \
+            f"{estimated_time_remaining.second} second{'' if estimated_time_remaining.second == 1 else 's'}"
+
+    if done_count == number_of_files:
+        print('    100 % done.')
+    else:
+        print(f'    {(100*done_count/number_of_files):.1f} % done, about {time_remaining_string} remaining...')
 
 
 def download_larger_media(media_sources, paths: PathConfig):
     """Uses (filename, URL) tuples in media_sources to download files from remote storage.
        Aborts downloads if the remote file is the same size or smaller than the existing local version.
        Retries the failed downloads several times, with increasing pauses between each to avoid being blocked.
+       Up to MAX_CONCURRENT_DOWNLOADS files are downloaded at the same time.
     """
+    # Make sure the modules are installed before any worker thread needs them (installing asks for consent)
+    import_module('requests')
+    import_module('imagesize')
+    # Drop duplicates, and files that don't exist locally (so there is nothing to compare against),
+    # before spending any requests on them
+    media_sources = [
+        (local_media_path, media_url) for local_media_path, media_url in dict.fromkeys(media_sources)
+        if os.path.isfile(local_media_path)
+    ]
+    # Load the sizes of the files that earlier runs found to be the best versions
+    media_cache = load_media_cache(paths)
     # Log to file as well as the console
     logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
     mkdirs_for_file(paths.file_download_log)
@@ -535,43 +822,41 @@ def download_larger_media(media_sources, paths: PathConfig):
     sleep_time = 0.25
     remaining_tries = 5
     while remaining_tries > 0:
-        number_of_files = len(media_sources)
+        # Some files are paired with several URLs (e.g. all videos of a tweet), so group the URLs by file
+        urls_by_file = defaultdict(list)
+        for local_media_path, media_url in media_sources:
+            urls_by_file[local_media_path].append(media_url)
+        number_of_files = len(urls_by_file)
         success_count = 0
         retries = []
-        for index, (local_media_path, media_url) in enumerate(media_sources):
-            success, bytes_downloaded = download_file_if_larger(
-                media_url, local_media_path, index + 1, number_of_files, sleep_time
-            )
-            if success:
-                success_count += 1
-            else:
-                retries.append((local_media_path, media_url))
-            total_bytes_downloaded += bytes_downloaded
-
-            # show % done and estimated remaining time:
-            time_elapsed: float = time.time() - start_time
-            estimated_time_per_file: float = time_elapsed / (index + 1)
-            estimated_time_remaining: datetime.datetime = \
-                datetime.datetime.fromtimestamp(
-                    (number_of_files - (index + 1)) * estimated_time_per_file,
-                    tz=datetime.timezone.utc
-                )
-            if estimated_time_remaining.hour >= 1:
-                time_remaining_string: str = \
-                    f"{estimated_time_remaining.hour} hour{'' if estimated_time_remaining.hour == 1 else 's'} " \
-                    f"{estimated_time_remaining.minute} minute{'' if estimated_time_remaining.minute == 1 else 's'}"
-            elif estimated_time_remaining.minute >= 1:
-                time_remaining_string: str = \
-                    f"{estimated_time_remaining.minute} minute{'' if estimated_time_remaining.minute == 1 else 's'} " \
-                    f"{estimated_time_remaining.second} second{'' if estimated_time_remaining.second == 1 else 's'}"
-            else:
-                time_remaining_string: str = \
-                    f"{estimated_time_remaining.second} second{'' if estimated_time_remaining.second == 1 else 's'}"
-
-            if index + 1 == number_of_files:
-                print('    100 % done.')
-            else:
-                print(f'    {(100*(index+1)/number_of_files):.1f} % done, about {time_remaining_string} remaining...')
+        # Start at most one request per sleep_time seconds on average (across all threads)
+        rate_limiter = TokenBucket(MAX_CONCURRENT_DOWNLOADS, MAX_CONCURRENT_DOWNLOADS * sleep_time)
+        try:
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS) as executor:
+                futures = {
+                    executor.submit(
+                        download_file_from_urls,
+                        media_urls, local_media_path, index + 1, number_of_files, rate_limiter, media_cache
+                    ): local_media_path
+                    for index, (local_media_path, media_urls) in enumerate(urls_by_file.items())
+                }
+                try:
+                    for done_count, future in enumerate(as_completed(futures), start=1):
+                        failed_urls, bytes_downloaded = future.result()
+                        if failed_urls:
+                            retries.extend((futures[future], media_url) for media_url in failed_urls)
+                        else:
+                            success_count += 1
+                        total_bytes_downloaded += bytes_downloaded
+                        print_download_progress(done_count, number_of_files, start_time)
+                except BaseException:
+                    # Don't start any more downloads if something went wrong or the user pressed Ctrl-C
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            # Keep what we learned so far, even if the downloads were interrupted
+            save_media_cache(media_cache, paths)
 
         media_sources = retries
         remaining_tries -= 1
@@ -598,10 +883,11 @@ def parse_tweets(username, users, html_template, paths: PathConfig):
    """
     tweets = []
     media_sources = []
+    input_media_files = index_files_by_id(paths.dir_input_media)
     for tweets_js_filename in paths.files_input_tweets:
         json = read_json_from_js_file(tweets_js_filename)
         for tweet in json:
-            tweets.append(convert_tweet(tweet, username, media_sources, users, paths))
+            tweets.append(convert_tweet(tweet, username, media_sources, users, input_media_files, paths))
     tweets.sort(key=lambda tup: tup[0]) # oldest first
 
     # Group tweets by month
@@ -630,72 +916,30 @@ def parse_tweets(username, users, html_template, paths: PathConfig):
     return media_sources
 
 
-def collect_user_ids_from_followings(paths) -> list:
-    """
-     Collect all user ids that appear in the followings archive data.
-     (For use in bulk online lookup from Twitter.)
-    """
-    # read JSON file from archive
-    following_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'following.js'))
-    # collect all user ids in a list
-    following_ids = []
-    for follow in following_json:
-        if 'following' in follow and 'accountId' in follow['following']:
-            following_ids.append(follow['following']['accountId'])
-    return following_ids
-
-
-def parse_followings(users, user_id_url_template, paths: PathConfig):
-    """Parse paths.dir_input_data/following.js, write to paths.file_output_following.
+def collect_user_ids_from_account_list(paths, kind: str) -> list:
     """
-    following = []
-    following_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'following.js'))
-    following_ids = []
-    for follow in following_json:
-        if 'following' in follow and 'accountId' in follow['following']:
-            following_ids.append(follow['following']['accountId'])
-    for following_id in following_ids:
-        handle = users[following_id].handle if following_id in users else '~unknown~handle~'
-        following.append(handle + ' ' + user_id_url_template.format(following_id))
-    following.sort()
-    following_output_path = paths.create_path_for_file_output_single(format="txt", kind="following")
-    with open_and_mkdirs(following_output_path) as f:
-        f.write('\n'.join(following))
-    print(f"Wrote {len(following)} accounts to {following_output_path}")
-
-
-def collect_user_ids_from_followers(paths) -> list:
-    """
-     Collect all user ids that appear in the followers archive data.
-     (For use in bulk online lookup from Twitter.)
+     Collect all user ids that appear in the followings (kind='following') or followers (kind='follower')
+     archive data. (For use in bulk online lookup from Twitter, and for writing the account lists.)
     """
     # read JSON file from archive
-    follower_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'follower.js'))
+    account_list_json = read_json_from_js_file(os.path.join(paths.dir_input_data, f'{kind}.js'))
     # collect all user ids in a list
-    follower_ids = []
-    for follower in follower_json:
-        if 'follower' in follower and 'accountId' in follower['follower']:
-            follower_ids.append(follower['follower']['accountId'])
-    return follower_ids
+    return [entry[kind]['accountId'] for entry in account_list_json if kind in entry and 'accountId' in entry[kind]]
 
 
-def parse_followers(users, user_id_url_template, paths: PathConfig):
-    """Parse paths.dir_input_data/followers.js, write to paths.file_output_followers.
+def write_account_list(account_ids, users, user_id_url_template, kind: str, paths: PathConfig):
+    """Write the handle and URL of each account in account_ids to paths.dir_output/{kind}.txt,
+       e.g. kind='following' or kind='followers'.
     """
-    followers = []
-    follower_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'follower.js'))
-    follower_ids = []
-    for follower in follower_json:
-        if 'follower' in follower and 'accountId' in follower['follower']:
-            follower_ids.append(follower['follower']['accountId'])
-    for follower_id in follower_ids:
-        handle = users[follower_id].handle if follower_id in users else '~unknown~handle~'
-        followers.append(handle + ' ' + user_id_url_template.format(follower_id))
-    followers.sort()
-    followers_output_path = paths.create_path_for_file_output_single(format="txt", kind="followers")
-    with open_and_mkdirs(followers_output_path) as f:
-        f.write('\n'.join(followers))
-    print(f"Wrote {len(followers)} accounts to {followers_output_path}")
+    accounts = []
+    for account_id in account_ids:
+        handle = users[account_id].handle if account_id in users else '~unknown~handle~'
+        accounts.append(handle + ' ' + user_id_url_template.format(account_id))
+    accounts.sort()
+    output_path = paths.create_path_for_file_output_single(format="txt", kind=kind)
+    with open_and_mkdirs(output_path) as f:
+        f.write('\n'.join(accounts))
+    print(f"Wrote {len(accounts)} accounts to {output_path}")
 
 
 def chunks(lst: list, n: int):
@@ -728,6 +972,7 @@ def parse_direct_messages(username, users, user_id_url_template, paths: PathConf
     """
     # read JSON file
     dms_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'direct-messages.js'))
+    input_media_files = index_files_by_id(os.path.join(paths.dir_input_data, 'direct_messages_media'))
 
     # Parse the DMs and store the messages in a dict
     conversations_messages = defaultdict(list)
@@ -741,7 +986,7 @@ def parse_direct_messages(username, users, user_id_url_template, paths: PathConf
                 for message in dm_conversation['messages']:
                     if 'messageCreate' in message:
                         message_create = message['messageCreate']
-                        if all(tag in message_create for tag in ['senderId', 'recipientId', 'text', 'createdAt']):
+                        if message_create.keys() >= DM_REQUIRED_KEYS:
                             from_id = message_create['senderId']
                             to_id = message_create['recipientId']
                             body = message_create['text']
@@ -759,8 +1004,9 @@ def parse_direct_messages(username, users, user_id_url_template, paths: PathConf
                                     and 'urls' in message_create:
                                 original_expanded_url = message_create['urls'][0]['expanded']
                                 message_id = message_create['id']
-                                media_hash_and_type = message_create['mediaUrls'][0].split('/')[-1]
-                                media_id = message_create['mediaUrls'][0].split('/')[-2]
+                                # parse the URL once, and ignore any query string when taking the path apart
+                                media_id, media_hash_and_type = \
+                                    urlparse(message_create['mediaUrls'][0]).path.split('/')[-2:]
                                 archive_media_filename = f'{message_id}-{media_hash_and_type}'
                                 new_url = os.path.join(paths.dir_output_media, archive_media_filename)
                                 archive_media_path = \
@@ -793,8 +1039,7 @@ def parse_direct_messages(username, users, user_id_url_template, paths: PathConf
                                     # )
 
                                 else:
-                                    archive_media_paths = glob.glob(
-                                        os.path.join(paths.dir_input_data, 'direct_messages_media', message_id + '*'))
+                                    archive_media_paths = input_media_files.get(message_id, [])
                                     if len(archive_media_paths) > 0:
                                         for archive_media_path in archive_media_paths:
                                             archive_media_filename = os.path.split(archive_media_path)[-1]
@@ -948,6 +1193,7 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
     """
     # read JSON file from archive
     group_dms_json = read_json_from_js_file(os.path.join(paths.dir_input_data, 'direct-messages-group.js'))
+    input_media_files = index_files_by_id(os.path.join(paths.dir_input_data, 'direct_messages_group_media'))
 
     # Parse the group DMs, store messages and metadata in a dict
     group_conversations_messages = defaultdict(list)
@@ -977,7 +1223,7 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
                 for message in dm_conversation['messages']:
                     if 'messageCreate' in message:
                         message_create = message['messageCreate']
-                        if all(tag in message_create for tag in ['senderId', 'text', 'createdAt']):
+                        if message_create.keys() >= GROUP_DM_REQUIRED_KEYS:
                             from_id = message_create['senderId']
                             # count how many messages this user has sent to the group
                             group_conversations_metadata[conversation_id]['participant_message_count'][from_id] += 1
@@ -996,8 +1242,9 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
                                     and 'urls' in message_create:
                                 original_expanded_url = message_create['urls'][0]['expanded']
                                 message_id = message_create['id']
-                                media_hash_and_type = message_create['mediaUrls'][0].split('/')[-1]
-                                media_id = message_create['mediaUrls'][0].split('/')[-2]
+                                # parse the URL once, and ignore any query string when taking the path apart
+                                media_id, media_hash_and_type = \
+                                    urlparse(message_create['mediaUrls'][0]).path.split('/')[-2:]
                                 archive_media_filename = f'{message_id}-{media_hash_and_type}'
                                 new_url = os.path.join(paths.dir_output_media, archive_media_filename)
                                 archive_media_path = \
@@ -1031,9 +1278,7 @@ def parse_group_direct_messages(username, users, user_id_url_template, paths):
                                     # )
 
                                 else:
-                                    archive_media_paths = glob.glob(
-                                        os.path.join(paths.dir_input_data, 'direct_messages_group_media',
-                                                     message_id + '*'))
+                                    archive_media_paths = input_media_files.get(message_id, [])
                                     if len(archive_media_paths) > 0:
                                         for archive_media_path in archive_media_paths:
                                             archive_media_filename = os.path.split(archive_media_path)[-1]
@@ -1327,9 +1572,15 @@ def main():
 
     media_sources = parse_tweets(username, users, html_template, paths)
 
-    following_ids = collect_user_ids_from_followings(paths)
+    # Re-use the user handles that were looked up online in earlier runs
+    known_users = load_known_users(paths)
+    for user_id, handle in known_users.items():
+        if user_id not in users:
+            users[user_id] = UserData(user_id=user_id, handle=handle)
+
+    following_ids = collect_user_ids_from_account_list(paths, kind='following')
     print(f'found {len(following_ids)} user IDs in followings.')
-    follower_ids = collect_user_ids_from_followers(paths)
+    follower_ids = collect_user_ids_from_account_list(paths, kind='follower')
     print(f'found {len(follower_ids)} user IDs in followers.')
     dms_user_ids = collect_user_ids_from_direct_messages(paths)
     print(f'found {len(dms_user_ids)} user IDs in direct messages.')
@@ -1368,10 +1619,11 @@ def main():
                            f'in the online lookup of user handles anyway?', default_to_yes=True):
             collected_user_ids = collected_user_ids_without_followers
 
-    lookup_users(collected_user_ids, users)
+    lookup_users(collected_user_ids, users, known_users, paths)
+    save_known_users(known_users, paths)
 
-    parse_followings(users, user_id_url_template, paths)
-    parse_followers(users, user_id_url_template, paths)
+    write_account_list(following_ids, users, user_id_url_template, kind='following', paths=paths)
+    write_account_list(follower_ids, users, user_id_url_template, kind='followers', paths=paths)
     parse_direct_messages(username, users, user_id_url_template, paths)
     parse_group_direct_messages(username, users, user_id_url_template, paths)
 